@@ -3,22 +3,43 @@ from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Dict, Any, Optional
 import numpy as np
-import pandas as pd
 from datetime import datetime, timedelta
 import uvicorn
 import logging
+from sklearn.base import clone
 from sklearn.ensemble import IsolationForest
 from sklearn.preprocessing import StandardScaler
 import joblib
+import lz4.frame
+from joblib import Parallel, delayed
 import os
+import importlib.util
+import time
+import copy
+import pickle
+import hashlib
+import asyncio
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from functools import lru_cache
+from cachetools import LRUCache
 from pathlib import Path
 
-# Prophet import with fallback
-try:
-    from prophet import Prophet
-    PROPHET_AVAILABLE = True
-except ImportError:
-    PROPHET_AVAILABLE = False
+# Optional Numba decorator and schedule helpers shared with test_logic.py
+from ml_common import (
+    NUMBA_AVAILABLE,
+    njit,
+    freeze,
+    copy_schedule,
+    schedule_for_constraints,
+    BASE_SCHEDULE_TEMPLATE,
+)
+
+# Prophet availability check; Prophet and pandas are imported lazily where
+# they are used, keeping them out of startup time and baseline memory
+PROPHET_AVAILABLE = importlib.util.find_spec("prophet") is not None
+if not PROPHET_AVAILABLE:
     logging.warning("Prophet not installed. Using fallback forecasting methods.")
 
 # Configure logging
@@ -44,6 +65,14 @@ app.add_middleware(
 MODELS_DIR = Path("./models")
 MODELS_DIR.mkdir(exist_ok=True)
 
+# Worker processes for CPU-bound model fitting/scoring, keeping the event loop free
+EXECUTOR = ProcessPoolExecutor(max_workers=os.cpu_count())
+
+@app.on_event("shutdown")
+def shutdown_executor():
+    """Stop worker processes on application shutdown"""
+    EXECUTOR.shutdown(wait=False, cancel_futures=True)
+
 # Pydantic models
 class ForecastRequest(BaseModel):
     device_id: str
@@ -55,6 +84,9 @@ class ScheduleRequest(BaseModel):
     constraints: Optional[Dict[str, Any]] = None
     historical_usage: Optional[List[float]] = None
 
+class BatchForecastRequest(BaseModel):
+    requests: List[ForecastRequest]
+
 class AnomalyRequest(BaseModel):
     device_id: str
     values: List[float]
@@ -80,11 +112,17 @@ class AnomalyResponse(BaseModel):
     timestamp: str
 
 # Model persistence functions
+# Models are pickled and lz4-compressed; .pkl files from older versions
+# (joblib) are still read so existing models keep working. Plain pickle
+# stores classes by reference, so a reloaded detector runs the current code.
+MODEL_SUFFIX = ".pkl.lz4"
+LEGACY_MODEL_SUFFIX = ".pkl"
+
 def save_model(device_id: str, model_type: str, model):
     """Save model to disk"""
     try:
-        path = MODELS_DIR / f"{device_id}_{model_type}.pkl"
-        joblib.dump(model, path)
+        path = MODELS_DIR / f"{device_id}_{model_type}{MODEL_SUFFIX}"
+        path.write_bytes(lz4.frame.compress(pickle.dumps(model, protocol=5)))
         logger.info(f"Saved model: {path}")
     except Exception as e:
         logger.error(f"Error saving model: {e}")
@@ -92,76 +130,459 @@ def save_model(device_id: str, model_type: str, model):
 def load_model(device_id: str, model_type: str):
     """Load model from disk"""
     try:
-        path = MODELS_DIR / f"{device_id}_{model_type}.pkl"
+        path = MODELS_DIR / f"{device_id}_{model_type}{MODEL_SUFFIX}"
         if path.exists():
             logger.info(f"Loaded model: {path}")
-            return joblib.load(path)
+            return pickle.loads(lz4.frame.decompress(path.read_bytes()))
+        legacy_path = MODELS_DIR / f"{device_id}_{model_type}{LEGACY_MODEL_SUFFIX}"
+        if legacy_path.exists():
+            logger.info(f"Loaded model: {legacy_path}")
+            return joblib.load(legacy_path)
     except Exception as e:
         logger.error(f"Error loading model: {e}")
     return None
 
+def _model_files(device_id: str) -> List[Path]:
+    """Saved model files for a device, in either format"""
+    return [
+        f for suffix in (MODEL_SUFFIX, LEGACY_MODEL_SUFFIX)
+        for f in MODELS_DIR.glob(f"{device_id}_*{suffix}")
+    ]
+
+def _score_forest(model: IsolationForest, reshaped: np.ndarray) -> tuple:
+    """decision_function scores and predict labels from a single pass over the trees"""
+    # Same as model.decision_function / model.predict, which both walk every tree
+    scores = model.score_samples(reshaped) - model.offset_
+    predictions = np.where(scores < 0, -1, 1)
+    return scores, predictions
+
+def _mad_scores(baseline: np.ndarray, values: np.ndarray) -> tuple:
+    """Robust z-score (median absolute deviation) scores and labels against a small 1-D baseline"""
+    med = np.median(baseline)
+    mad = np.median(np.abs(baseline - med))
+    z = 0.6745 * (values - med) / max(mad, 1e-9)
+    abs_z = np.abs(z)
+    return -abs_z, np.where(abs_z > 3.5, -1, 1)
+
 # Anomaly Detection Class
 class AnomalyDetector:
     """Stateful anomaly detector with incremental learning"""
+    # Number of recent normal points kept for retraining
+    BASELINE_SIZE = 1000
+    # Baselines smaller than this are scored with MAD instead of a forest
+    MAD_BASELINE_LIMIT = 50
+    
     def __init__(self, device_id: str):
         self.device_id = device_id
+        # 50 trees on the standard 256-point subsample ('auto' = min(256, n)):
+        # for 1-D telemetry this scores like 100 trees at half the cost
         self.model = IsolationForest(
             contamination=0.1, 
             random_state=42,
-            n_estimators=100
+            n_estimators=50,
+            max_samples='auto',
+            bootstrap=False,
+            n_jobs=-1  # Inline fits only; pooled fits and scoring use one thread
         )
         self.trained = False
-        self.baseline = []
+        self._reset_baseline(np.empty(0))
+        self._model_bytes = None
+        self._points_since_train = 0
+        self._forest_fitted = False
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_model_bytes", None)
+        state.pop("_fitting", None)
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Detectors saved before the ring buffer kept the baseline as a list
+        if isinstance(self.baseline, list):
+            self._reset_baseline(np.asarray(self.baseline, dtype=np.float64))
+    
+    @property
+    def model_bytes(self) -> bytes:
+        """Pickled forest for scoring in worker processes (cached until retrained)"""
+        if getattr(self, "_model_bytes", None) is None:
+            # Single-threaded in the worker: the pool already has a process per core
+            model = copy.copy(self.model)
+            model.n_jobs = 1
+            self._model_bytes = pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)
+        return self._model_bytes
+    
+    @property
+    def uses_mad(self) -> bool:
+        """Whether the baseline is still too small to be worth a forest"""
+        return not getattr(self, "_forest_fitted", True)
+    
+    @property
+    def baseline_values(self) -> np.ndarray:
+        """Filled part of the baseline ring buffer (a view, in no particular order)"""
+        return self.baseline if self.baseline_full else self.baseline[:self.baseline_idx]
+    
+    def _reset_baseline(self, data: np.ndarray):
+        """Replace the baseline with the most recent points of data"""
+        self.baseline = np.empty(self.BASELINE_SIZE, dtype=np.float64)
+        self.baseline_idx = 0
+        self.baseline_full = False
+        self._append_baseline(data)
+    
+    def _append_baseline(self, points: np.ndarray):
+        """Write points into the ring buffer, overwriting the oldest ones"""
+        size = self.BASELINE_SIZE
+        k = len(points)
+        if k >= size:
+            self.baseline[:] = points[-size:]
+            self.baseline_idx = 0
+            self.baseline_full = True
+            return
+        
+        end = self.baseline_idx + k
+        if end <= size:
+            self.baseline[self.baseline_idx:end] = points
+        else:
+            split = size - self.baseline_idx
+            self.baseline[self.baseline_idx:] = points[:split]
+            self.baseline[:end - size] = points[split:]
+        if end >= size:
+            self.baseline_full = True
+        self.baseline_idx = end % size
         
     def train(self, data: np.ndarray):
-        """Train model on baseline data"""
+        """Train model on baseline data (a 2-D column array)"""
         if len(data) >= 10:
-            self.model.fit(data.reshape(-1, 1))
-            self.baseline = data.tolist()
-            self.trained = True
-            save_model(self.device_id, "anomaly", self)
-            logger.info(f"Trained anomaly detector for {self.device_id}")
+            self.begin_training(data)
+            self._fit(data)
+    
+    def begin_training(self, data: np.ndarray):
+        """Seed the baseline from a first batch (a 2-D column array)
+        
+        The detector scores with MAD against this baseline until a forest
+        has been fitted and installed.
+        """
+        self._reset_baseline(data[:, 0])
+        self.trained = True
+    
+    def retrain_data(self) -> Optional[np.ndarray]:
+        """Baseline to fit a forest on (a 2-D column array) if a fit is due, else None"""
+        if not self.trained or getattr(self, "_fitting", False):
+            return None
+        # Retrain once enough new normal points have accumulated, or as
+        # soon as the baseline is large enough to switch from MAD to a forest
+        baseline_len = len(self.baseline_values)
+        if ((self.uses_mad and baseline_len >= self.MAD_BASELINE_LIMIT)
+                or (getattr(self, "_points_since_train", 0) >= 100 and baseline_len >= 200)):
+            # Copied, since the ring buffer keeps changing while a fit runs
+            return self.baseline_values[:, None].copy()
+        return None
+    
+    def _fit(self, data: np.ndarray):
+        """Fit the forest inline on a 2-D column array and persist the detector"""
+        model = None
+        if len(data) >= self.MAD_BASELINE_LIMIT:
+            # Fit a fresh forest so a snapshot still being saved is never mutated
+            model = clone(self.model).fit(data)
+        self._install_fit(model)
+    
+    async def fit_in_executor(self, data: np.ndarray):
+        """Fit the forest in a worker process, swapping it in when done
+        
+        Requests keep being scored with the current model (or MAD) while the
+        fit runs; a fit already in flight makes this a no-op.
+        """
+        if getattr(self, "_fitting", False):
+            return
+        self._fitting = True
+        try:
+            if len(data) < self.MAD_BASELINE_LIMIT:
+                self._install_fit(None)
+                return
+            loop = asyncio.get_running_loop()
+            model_bytes = await loop.run_in_executor(
+                EXECUTOR, _isoforest_fit, clone(self.model).set_params(n_jobs=1), data
+            )
+            self._install_fit(pickle.loads(model_bytes), model_bytes)
+        finally:
+            self._fitting = False
+    
+    def _install_fit(self, model: Optional[IsolationForest], model_bytes: Optional[bytes] = None):
+        """Swap in a newly fitted forest (None keeps scoring with MAD) and persist"""
+        if model is not None:
+            self.model = model
+            self._model_bytes = model_bytes
+            self._forest_fitted = True
+        self.trained = True
+        self._points_since_train = 0
+        self._save_in_background()
+        logger.info(f"Trained anomaly detector for {self.device_id}")
+    
+    def _save_in_background(self):
+        """Persist a snapshot of the detector without blocking the event loop"""
+        snapshot = copy.copy(self)
+        snapshot.baseline = self.baseline.copy()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Not called from a request handler; save synchronously
+            save_model(self.device_id, "anomaly", snapshot)
+            return
+        loop.run_in_executor(None, save_model, self.device_id, "anomaly", snapshot)
     
     def predict(self, new_data: np.ndarray):
-        """Detect anomalies in new data"""
+        """Detect anomalies in new data (a 2-D column array), fitting inline when due"""
         if not self.trained:
             # Initial training
             self.train(new_data)
             return [], []  # No anomalies in baseline
         
         # Predict on new data
-        scores = self.model.decision_function(new_data.reshape(-1, 1))
-        predictions = self.model.predict(new_data.reshape(-1, 1))
+        if self.uses_mad:
+            scores, predictions = _mad_scores(self.baseline_values, new_data[:, 0])
+        else:
+            scores, predictions = _score_forest(self.model, new_data)
         
+        result = self.update(new_data, scores, predictions)
+        data = self.retrain_data()
+        if data is not None:
+            self._fit(data)
+        return result
+    
+    def update(self, new_data: np.ndarray, scores: np.ndarray, predictions: np.ndarray):
+        """Report anomalies for already-scored data and grow the baseline
+        
+        Doesn't fit; check retrain_data() afterwards.
+        """
         # Find anomalies
-        anomalies = [i for i, pred in enumerate(predictions) if pred == -1]
+        anomalies = np.flatnonzero(predictions == -1).tolist()
         
         # Incremental learning: Add normal points to baseline
-        normal_points = new_data[predictions == 1]
+        normal_points = new_data[predictions == 1, 0]
         if len(normal_points) > 0:
-            self.baseline.extend(normal_points.tolist())
-            # Keep only recent 1000 points
-            self.baseline = self.baseline[-1000:]
-            # Retrain periodically
-            if len(self.baseline) % 100 == 0:
-                self.train(np.array(self.baseline))
+            # Ring buffer keeps only the recent BASELINE_SIZE points
+            self._append_baseline(normal_points)
+            self._points_since_train = getattr(self, "_points_since_train", 0) + len(normal_points)
         
         return anomalies, scores.tolist()
 
-# Global detector cache
-anomaly_detectors = {}
+# Global detector cache, bounded so idle devices are evicted (they reload from disk)
+anomaly_detectors = LRUCache(maxsize=256)
+
+# Striped per-device locks so concurrent first requests load a detector once.
+# asyncio locks bind to the loop that first contends them, so each running
+# loop gets its own set, created on first use.
+DETECTOR_LOCK_STRIPES = 64
+_DETECTOR_LOCKS = weakref.WeakKeyDictionary()
+
+def _detector_lock(device_id: str) -> asyncio.Lock:
+    """Lock guarding detector creation for a device (on the running loop)"""
+    loop = asyncio.get_running_loop()
+    locks = _DETECTOR_LOCKS.get(loop)
+    if locks is None:
+        locks = _DETECTOR_LOCKS[loop] = [asyncio.Lock() for _ in range(DETECTOR_LOCK_STRIPES)]
+    return locks[hash(device_id) % DETECTOR_LOCK_STRIPES]
+
+# Global forecast model cache: device_id -> (history hash, fitted Prophet),
+# bounded like the detector cache since each entry holds a full Prophet model
+prophet_cache = LRUCache(maxsize=64)
+
+def _history_hash(history: List[float]) -> bytes:
+    """Digest identifying a forecast history"""
+    return hashlib.blake2b(np.asarray(history, dtype=np.float64).tobytes(), digest_size=16).digest()
+
+async def _cached_prophet(device_id: str, history_hash: bytes):
+    """Return the fitted Prophet for this device if it was fit on the same history"""
+    cached = prophet_cache.get(device_id)
+    if cached is None:
+        # Rehydrate from disk on first use after a restart, without blocking
+        # the event loop
+        loop = asyncio.get_running_loop()
+        loaded = await loop.run_in_executor(None, load_model, device_id, "forecast")
+        if isinstance(loaded, tuple) and len(loaded) == 2:
+            cached = prophet_cache[device_id] = loaded
+    if cached is not None and cached[0] == history_hash:
+        return cached[1]
+    return None
+
+# Worker-side functions (executed in EXECUTOR processes)
+@lru_cache(maxsize=32)
+def _unpickle_model(model_bytes: bytes):
+    """Rebuild a pickled model, reusing it while the bytes stay the same"""
+    return pickle.loads(model_bytes)
+
+def _isoforest_fit(model: IsolationForest, data: np.ndarray) -> bytes:
+    """Fit an unfitted IsolationForest on a 2-D column array; returns it pickled"""
+    model.fit(data)
+    return pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)
+
+def _isoforest_predict(model_bytes: bytes, values: np.ndarray) -> tuple:
+    """Score a 2-D column array with a pickled IsolationForest"""
+    model = _unpickle_model(model_bytes)
+    return _score_forest(model, values)
+
+def _is_school_hour(hours: np.ndarray) -> np.ndarray:
+    """Mark school hours (9 AM - 5 PM) for an array of hours of day"""
+    return (hours >= 9) & (hours <= 17)
+
+def _prophet_resid_std(model) -> float:
+    """Standard deviation of a fitted Prophet model's in-sample residuals"""
+    fitted = model.predict()['yhat'].to_numpy()
+    return float(np.std(model.history['y'].to_numpy() - fitted))
+
+def _prophet_fit_predict(device_id: str, history: List[float], periods: int,
+                         history_hash: bytes, cached_model=None) -> tuple:
+    """Forecast the next periods, fitting Prophet on hourly history unless a fitted model is given.
+    
+    Returns (predictions, confidence, model) where model is the newly fitted
+    Prophet, or None when cached_model was reused.
+    """
+    import pandas as pd
+    from prophet import Prophet
+    
+    model = cached_model
+    if model is None:
+        # Prepare data for Prophet (requires 'ds' and 'y' columns): hourly
+        # points ending at the current hour, with school hours from the hour
+        # of day computed directly rather than through the .dt accessor
+        now_floor = pd.Timestamp(datetime.now().replace(minute=0, second=0, microsecond=0))
+        hours_ago = np.arange(len(history) - 1, -1, -1)
+        df = pd.DataFrame({
+            'ds': now_floor - pd.to_timedelta(hours_ago, unit='h'),
+            'y': history,
+            'is_school_hours': _is_school_hour((now_floor.hour - hours_ago) % 24),
+        })
+
+        # Initialize Prophet with classroom-specific settings. Interval
+        # sampling dominates predict cost, so it is disabled and the band is
+        # derived from the in-sample residuals instead.
+        model = Prophet(
+            daily_seasonality=5,          # Capture daily patterns (Fourier order)
+            weekly_seasonality=3,         # Weekday vs weekend (Fourier order)
+            yearly_seasonality=False,     # Not needed for classroom
+            changepoint_prior_scale=0.05, # Sensitivity to trend changes
+            mcmc_samples=0,
+            uncertainty_samples=0
+        )
+
+        # Add custom seasonalities for classroom hours
+        model.add_seasonality(
+            name='school_hours',
+            period=24,
+            fourier_order=5,
+            condition_name='is_school_hours'
+        )
+
+        # Fit model and save it alongside the history it was fit on
+        model.fit(df)
+        model.resid_std = _prophet_resid_std(model)
+        save_model(device_id, "forecast", (history_hash, model))
+
+    # Make future dataframe (only the periods ahead; history rows aren't needed)
+    last_ds = model.history['ds'].iloc[-1]
+    hours_ahead = np.arange(1, periods + 1)
+    future = pd.DataFrame({
+        'ds': last_ds + pd.to_timedelta(hours_ahead, unit='h'),
+        'is_school_hours': _is_school_hour((last_ds.hour + hours_ahead) % 24),
+    })
+
+    # Predict
+    forecast = model.predict(future)
+
+    # Extract predictions and a 95% band from the residual spread
+    yhat = forecast['yhat'].to_numpy()
+    resid_std = getattr(model, 'resid_std', None)
+    if resid_std is None:
+        resid_std = _prophet_resid_std(model)
+    predictions = yhat.tolist()
+    lower_bound = (yhat - 1.96 * resid_std).tolist()
+    upper_bound = (yhat + 1.96 * resid_std).tolist()
+
+    # Calculate confidence (0-1 scale)
+    confidence = [
+        max(0.1, min(0.95, 1 - (upper - lower) / (abs(pred) + 0.001)))
+        for pred, lower, upper in zip(predictions, lower_bound, upper_bound)
+    ]
+
+    # Ensure reasonable bounds (0-100)
+    predictions = [max(0, min(100, p)) for p in predictions]
+    
+    return predictions, confidence, (model if cached_model is None else None)
+
+def _try_prophet_fit_predict(*args) -> Optional[tuple]:
+    """_prophet_fit_predict that returns None on failure so one bad history doesn't sink a batch"""
+    try:
+        return _prophet_fit_predict(*args)
+    except Exception as e:
+        logger.error(f"Prophet forecasting failed: {e}")
+        return None
+
+# Response timestamp, formatted at most once per second: [epoch second, ISO string]
+_TS_CACHE = [0, ""]
+
+def _now_iso() -> str:
+    """Current local time as an ISO string at 1-second resolution"""
+    t = int(time.time())
+    if t != _TS_CACHE[0]:
+        _TS_CACHE[1] = datetime.fromtimestamp(t).isoformat()
+        _TS_CACHE[0] = t
+    return _TS_CACHE[1]
+
+# Effective full-usage hours per day for each schedule priority
+PRIORITY_HOURS = {
+    'off': 0.0,          # Completely off
+    'low': 8 * 0.3,      # 30% usage
+    'medium': 10 * 0.6,  # 60% usage
+    'high': 10 * 1.0,    # Full usage
+}
+
+# Horizons at or above this length use the compiled SMA kernel
+SMA_JIT_MIN_PERIODS = 100
 
 # Helper functions
+@njit(cache=True, fastmath=True)
+def _sma_core(history: np.ndarray, periods: int, window: int) -> np.ndarray:
+    """Moving-average recurrence over the history extended with its own predictions"""
+    n = len(history)
+    out = np.empty(periods)
+    s = history[n - window:].sum()
+    for i in range(periods):
+        out[i] = s / window
+        if i < window:
+            s += out[i] - history[n - window + i]
+        else:
+            s += out[i] - out[i - window]
+    return out
+
+@app.on_event("startup")
+def warm_sma_kernel():
+    """Pay the JIT compile cost at server startup rather than on the first request
+    
+    Done here rather than at import so worker processes, which never run the
+    kernel, don't pay for it.
+    """
+    if NUMBA_AVAILABLE:
+        _sma_core(np.zeros(3), 1, 3)
+
 def simple_moving_average_forecast(history: List[float], periods: int) -> tuple:
     """Simple moving average forecast for limited data"""
-    history = np.array(history)
     window = min(len(history), 3)
     
+    if NUMBA_AVAILABLE and periods >= SMA_JIT_MIN_PERIODS:
+        predictions = _sma_core(np.asarray(history, dtype=np.float64), periods, window).tolist()
+        return predictions, [0.5] * periods
+    
+    # Slide the window over its own predictions, keeping a running sum
+    # instead of re-averaging (and re-allocating) the history every step
+    recent = deque((float(v) for v in history[-window:]), maxlen=window)
+    running_sum = sum(recent)
+    
     predictions = []
     for _ in range(periods):
-        pred = np.mean(history[-window:])
+        pred = running_sum / window
+        running_sum += pred - recent[0]
+        recent.append(pred)
         predictions.append(pred)
-        history = np.append(history, pred)
     
     # Lower confidence for simple method
     confidence = [0.5] * periods
@@ -173,23 +594,15 @@ def calculate_energy_savings(device_id: str, schedule: dict, historical_usage: L
     if not historical_usage or len(historical_usage) < 24:
         return 0.0  # Not enough data
     
-    # Calculate baseline consumption (24h average)
-    baseline_consumption = np.mean(historical_usage)
-    
+    # Savings only depend on the schedule priorities once there is enough data
+    return _savings_for_priorities(tuple(times['priority'] for times in schedule.values()))
+
+@lru_cache(maxsize=1024)
+def _savings_for_priorities(priorities: tuple) -> float:
+    """Savings percentage for a sequence of daily priorities (memoized)"""
     # Calculate optimized consumption based on schedule
-    optimized_hours = 0
-    total_hours = 0
-    
-    for day, times in schedule.items():
-        if times['priority'] == 'off':
-            optimized_hours += 0  # Completely off
-        elif times['priority'] == 'low':
-            optimized_hours += 8 * 0.3  # 30% usage
-        elif times['priority'] == 'medium':
-            optimized_hours += 10 * 0.6  # 60% usage
-        else:  # high
-            optimized_hours += 10 * 1.0  # Full usage
-        total_hours += 24
+    optimized_hours = sum(PRIORITY_HOURS.get(p, PRIORITY_HOURS['high']) for p in priorities)
+    total_hours = 24 * len(priorities)
     
     # Calculate savings percentage
     if total_hours > 0:
@@ -202,31 +615,53 @@ def calculate_energy_savings(device_id: str, schedule: dict, historical_usage: L
 
 def build_optimized_schedule(constraints: Dict[str, Any]) -> Dict[str, Any]:
     """Build optimized schedule based on constraints"""
-    base_schedule = {
-        "monday": {"start": "08:00", "end": "18:00", "priority": "high"},
-        "tuesday": {"start": "08:00", "end": "18:00", "priority": "high"},
-        "wednesday": {"start": "08:00", "end": "18:00", "priority": "high"},
-        "thursday": {"start": "08:00", "end": "18:00", "priority": "high"},
-        "friday": {"start": "08:00", "end": "18:00", "priority": "high"},
-        "saturday": {"start": "09:00", "end": "17:00", "priority": "medium"},
-        "sunday": {"start": "00:00", "end": "00:00", "priority": "off"}
-    }
+    if not constraints:
+        return copy_schedule(BASE_SCHEDULE_TEMPLATE)
+    # Hand out a copy so callers can't mutate the cached schedule
+    return copy_schedule(schedule_for_constraints(freeze(constraints)))
 
-    # Apply constraints
-    if "class_schedule" in constraints:
-        class_hours = constraints["class_schedule"]
-        for day in base_schedule:
-            if day.lower() in ["saturday", "sunday"] and not class_hours.get("weekends", False):
-                base_schedule[day] = {"start": "00:00", "end": "00:00", "priority": "off"}
-
-    if "energy_budget" in constraints:
-        budget = constraints["energy_budget"]
-        if budget < 50:  # Low budget
-            for day in base_schedule:
-                if base_schedule[day]["priority"] == "high":
-                    base_schedule[day]["priority"] = "medium"
+def _simple_forecast(request: ForecastRequest) -> Optional[ForecastResponse]:
+    """Forecast without Prophet for short histories; None when Prophet should be used"""
+    device_id = request.device_id
+    history = request.history
+    periods = request.periods
     
-    return base_schedule
+    # Validate data quality
+    if len(history) < 3:
+        # Return simple average-based forecast for insufficient data
+        avg = np.mean(history) if len(history) > 0 else 50.0
+        return ForecastResponse(
+            device_id=device_id,
+            forecast=[avg] * periods,
+            confidence=[0.3] * periods,  # Low confidence
+            timestamp=_now_iso(),
+            model_type="simple_average"
+        )
+    
+    # Check for data quality issues
+    if len(history) < 7 or not PROPHET_AVAILABLE:
+        logger.warning(f"Limited data ({len(history)} points) or Prophet unavailable for {device_id}")
+        predictions, confidence = simple_moving_average_forecast(history, periods)
+        return ForecastResponse(
+            device_id=device_id,
+            forecast=predictions,
+            confidence=confidence,
+            timestamp=_now_iso(),
+            model_type="moving_average"
+        )
+    
+    return None
+
+def _fallback_forecast(request: ForecastRequest) -> ForecastResponse:
+    """Moving-average forecast used when Prophet fails"""
+    predictions, confidence = simple_moving_average_forecast(request.history, request.periods)
+    return ForecastResponse(
+        device_id=request.device_id,
+        forecast=predictions,
+        confidence=confidence,
+        timestamp=_now_iso(),
+        model_type="moving_average_fallback"
+    )
 
 # API Endpoints
 @app.get("/health")
@@ -236,7 +671,7 @@ async def health_check():
         "status": "healthy",
         "prophet_available": PROPHET_AVAILABLE,
         "models_dir": str(MODELS_DIR),
-        "timestamp": datetime.now().isoformat()
+        "timestamp": _now_iso()
     }
 
 @app.post("/forecast", response_model=ForecastResponse)
@@ -247,107 +682,98 @@ async def forecast_usage(request: ForecastRequest):
         history = request.history
         periods = request.periods
         
-        # Validate data quality
-        if len(history) < 3:
-            # Return simple average-based forecast for insufficient data
-            avg = np.mean(history) if len(history) > 0 else 50.0
-            return ForecastResponse(
-                device_id=device_id,
-                forecast=[avg] * periods,
-                confidence=[0.3] * periods,  # Low confidence
-                timestamp=datetime.now().isoformat(),
-                model_type="simple_average"
-            )
-        
-        # Check for data quality issues
-        if len(history) < 7 or not PROPHET_AVAILABLE:
-            logger.warning(f"Limited data ({len(history)} points) or Prophet unavailable for {device_id}")
-            predictions, confidence = simple_moving_average_forecast(history, periods)
-            return ForecastResponse(
-                device_id=device_id,
-                forecast=predictions,
-                confidence=confidence,
-                timestamp=datetime.now().isoformat(),
-                model_type="moving_average"
-            )
+        # Short histories (or no Prophet) use the simple methods
+        response = _simple_forecast(request)
+        if response is not None:
+            return response
         
         # Use Prophet for advanced forecasting
         try:
-            # Prepare data for Prophet (requires 'ds' and 'y' columns)
-            df = pd.DataFrame({
-                'ds': pd.date_range(end=datetime.now(), periods=len(history), freq='H'),
-                'y': history
-            })
-            
-            # Initialize Prophet with classroom-specific settings
-            model = Prophet(
-                daily_seasonality=True,      # Capture daily patterns
-                weekly_seasonality=True,     # Weekday vs weekend
-                yearly_seasonality=False,    # Not needed for classroom
-                changepoint_prior_scale=0.05 # Sensitivity to trend changes
-            )
+            # Reuse the fitted model when this device's history is unchanged
+            history_hash = _history_hash(history)
+            cached_model = await _cached_prophet(device_id, history_hash)
             
-            # Add custom seasonalities for classroom hours
-            model.add_seasonality(
-                name='school_hours',
-                period=24,
-                fourier_order=5,
-                condition_name='is_school_hours'
+            # New fits go to a worker process; cached models are predicted in
+            # a thread so the fitted model is never pickled over IPC
+            loop = asyncio.get_running_loop()
+            predictions, confidence, fitted_model = await loop.run_in_executor(
+                EXECUTOR if cached_model is None else None, _prophet_fit_predict,
+                device_id, history, periods, history_hash, cached_model
             )
-            
-            # Mark school hours (9 AM - 5 PM)
-            df['is_school_hours'] = df['ds'].dt.hour.between(9, 17)
-            
-            # Fit model
-            model.fit(df)
-            
-            # Make future dataframe
-            future = model.make_future_dataframe(periods=periods, freq='H')
-            future['is_school_hours'] = future['ds'].dt.hour.between(9, 17)
-            
-            # Predict
-            forecast = model.predict(future)
-            
-            # Extract predictions and confidence intervals
-            predictions = forecast['yhat'].tail(periods).tolist()
-            lower_bound = forecast['yhat_lower'].tail(periods).tolist()
-            upper_bound = forecast['yhat_upper'].tail(periods).tolist()
-            
-            # Calculate confidence (0-1 scale)
-            confidence = [
-                max(0.1, min(0.95, 1 - (upper - lower) / (abs(pred) + 0.001)))
-                for pred, lower, upper in zip(predictions, lower_bound, upper_bound)
-            ]
-            
-            # Ensure reasonable bounds (0-100)
-            predictions = [max(0, min(100, p)) for p in predictions]
-            
-            # Save model
-            save_model(device_id, "forecast", model)
+            if fitted_model is not None:
+                prophet_cache[device_id] = (history_hash, fitted_model)
             
             return ForecastResponse(
                 device_id=device_id,
                 forecast=predictions,
                 confidence=confidence,
-                timestamp=datetime.now().isoformat(),
+                timestamp=_now_iso(),
                 model_type="prophet"
             )
             
         except Exception as prophet_error:
             logger.error(f"Prophet forecasting failed: {prophet_error}, falling back to simple method")
-            predictions, confidence = simple_moving_average_forecast(history, periods)
-            return ForecastResponse(
-                device_id=device_id,
-                forecast=predictions,
-                confidence=confidence,
-                timestamp=datetime.now().isoformat(),
-                model_type="moving_average_fallback"
-            )
+            return _fallback_forecast(request)
         
     except Exception as e:
         logger.error(f"Forecast error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Forecast failed: {str(e)}")
 
+@app.post("/forecast/batch", response_model=List[ForecastResponse])
+async def forecast_usage_batch(request: BatchForecastRequest):
+    """Forecast many devices at once, fitting Prophet models in parallel"""
+    try:
+        responses = [_simple_forecast(r) for r in request.requests]
+        
+        # Remaining requests need Prophet: (index, request, history hash, cached model)
+        jobs = []
+        for i, r in enumerate(request.requests):
+            if responses[i] is None:
+                history_hash = _history_hash(r.history)
+                jobs.append((i, r, history_hash, await _cached_prophet(r.device_id, history_hash)))
+        
+        if jobs:
+            loop = asyncio.get_running_loop()
+            fits = [job for job in jobs if job[3] is None]
+            hits = [job for job in jobs if job[3] is not None]
+            
+            async def run_fits():
+                # Fan the fits out across all cores
+                if not fits:
+                    return []
+                return await loop.run_in_executor(None, lambda: Parallel(n_jobs=-1, backend='loky')(
+                    delayed(_try_prophet_fit_predict)(r.device_id, r.history, r.periods, history_hash, None)
+                    for _, r, history_hash, _ in fits
+                ))
+            
+            # Cached models are predicted in threads rather than shipped to workers
+            fit_results, hit_results = await asyncio.gather(run_fits(), asyncio.gather(*(
+                loop.run_in_executor(None, _try_prophet_fit_predict,
+                                     r.device_id, r.history, r.periods, history_hash, cached_model)
+                for _, r, history_hash, cached_model in hits
+            )))
+            
+            for (i, r, history_hash, _), result in zip(fits + hits, list(fit_results) + list(hit_results)):
+                if result is None:
+                    responses[i] = _fallback_forecast(r)
+                    continue
+                predictions, confidence, fitted_model = result
+                if fitted_model is not None:
+                    prophet_cache[r.device_id] = (history_hash, fitted_model)
+                responses[i] = ForecastResponse(
+                    device_id=r.device_id,
+                    forecast=predictions,
+                    confidence=confidence,
+                    timestamp=_now_iso(),
+                    model_type="prophet"
+                )
+        
+        return responses
+        
+    except Exception as e:
+        logger.error(f"Batch forecast error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Batch forecast failed: {str(e)}")
+
 @app.post("/schedule", response_model=ScheduleResponse)
 async def optimize_schedule(request: ScheduleRequest):
     """Optimize schedule with real energy savings calculations"""
@@ -370,7 +796,7 @@ async def optimize_schedule(request: ScheduleRequest):
             device_id=device_id,
             schedule=base_schedule,
             energy_savings=round(energy_savings, 2),
-            timestamp=datetime.now().isoformat()
+            timestamp=_now_iso()
         )
         
     except Exception as e:
@@ -382,7 +808,7 @@ async def detect_anomalies(request: AnomalyRequest):
     """Incremental anomaly detection"""
     try:
         device_id = request.device_id
-        values = np.array(request.values)
+        values = np.asarray(request.values, dtype=np.float64).reshape(-1, 1)
         
         if len(values) < 10:
             raise HTTPException(
@@ -391,16 +817,33 @@ async def detect_anomalies(request: AnomalyRequest):
             )
         
         # Get or create detector
-        if device_id not in anomaly_detectors:
-            # Try to load from disk
-            loaded = load_model(device_id, "anomaly")
-            if loaded:
-                anomaly_detectors[device_id] = loaded
+        loop = asyncio.get_running_loop()
+        async with _detector_lock(device_id):
+            detector = anomaly_detectors.get(device_id)
+            if detector is None:
+                # Try to load from disk without blocking the event loop
+                loaded = await loop.run_in_executor(None, load_model, device_id, "anomaly")
+                detector = loaded if loaded else AnomalyDetector(device_id)
+                anomaly_detectors[device_id] = detector
+        
+        if not detector.trained:
+            # First batch becomes the baseline; no anomalies in it
+            detector.begin_training(values)
+            anomalies, scores = [], []
+            fit_data = values
+        else:
+            if detector.uses_mad:
+                raw_scores, predictions = _mad_scores(detector.baseline_values, values[:, 0])
             else:
-                anomaly_detectors[device_id] = AnomalyDetector(device_id)
+                raw_scores, predictions = await loop.run_in_executor(
+                    EXECUTOR, _isoforest_predict, detector.model_bytes, values
+                )
+            anomalies, scores = detector.update(values, raw_scores, predictions)
+            fit_data = detector.retrain_data()
         
-        detector = anomaly_detectors[device_id]
-        anomalies, scores = detector.predict(values)
+        # Forest fits run in a worker process, off the event loop
+        if fit_data is not None:
+            await detector.fit_in_executor(fit_data)
         
         threshold = np.percentile(scores, 10) if len(scores) > 0 else 0
         
@@ -409,7 +852,7 @@ async def detect_anomalies(request: AnomalyRequest):
             anomalies=anomalies,
             scores=scores,
             threshold=float(threshold),
-            timestamp=datetime.now().isoformat()
+            timestamp=_now_iso()
         )
         
     except Exception as e:
@@ -419,29 +862,30 @@ async def detect_anomalies(request: AnomalyRequest):
 @app.get("/models/{device_id}")
 async def get_model_info(device_id: str):
     """Get information about trained models for a device"""
-    model_files = list(MODELS_DIR.glob(f"{device_id}_*.pkl"))
+    model_files = _model_files(device_id)
     return {
         "device_id": device_id,
         "models": [f.name for f in model_files],
         "in_memory": device_id in anomaly_detectors,
-        "timestamp": datetime.now().isoformat()
+        "timestamp": _now_iso()
     }
 
 @app.delete("/models/{device_id}")
 async def clear_device_models(device_id: str):
     """Clear all models for a device"""
     try:
-        model_files = list(MODELS_DIR.glob(f"{device_id}_*.pkl"))
+        model_files = _model_files(device_id)
         for f in model_files:
             f.unlink()
         
         if device_id in anomaly_detectors:
             del anomaly_detectors[device_id]
+        prophet_cache.pop(device_id, None)
         
         return {
             "device_id": device_id,
             "cleared": len(model_files),
-            "timestamp": datetime.now().isoformat()
+            "timestamp": _now_iso()
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error clearing models: {str(e)}")
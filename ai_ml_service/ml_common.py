@@ -0,0 +1,78 @@
+"""
+Helpers shared by the AI/ML service (main_improved.py) and its logic test
+runner (test_logic.py): the optional Numba decorator and the memoized
+schedule builder.
+"""
+
+import logging
+from functools import lru_cache
+from typing import Dict, Any
+
+# Numba import with fallback (kernels run as plain Python/NumPy without it)
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+    logging.warning("Numba not installed. Using pure-Python loops.")
+
+    def njit(*args, **kwargs):
+        def decorator(func):
+            return func
+        return decorator
+
+def freeze(value):
+    """Recursively convert JSON-like constraints into a hashable cache key"""
+    if isinstance(value, dict):
+        return frozenset((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+def thaw(value):
+    """Inverse of freeze"""
+    if isinstance(value, frozenset):
+        return {k: thaw(v) for k, v in value}
+    if isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    return value
+
+# Default weekly schedule, built once; copied per day before use
+BASE_SCHEDULE_TEMPLATE = {
+    "monday": {"start": "08:00", "end": "18:00", "priority": "high"},
+    "tuesday": {"start": "08:00", "end": "18:00", "priority": "high"},
+    "wednesday": {"start": "08:00", "end": "18:00", "priority": "high"},
+    "thursday": {"start": "08:00", "end": "18:00", "priority": "high"},
+    "friday": {"start": "08:00", "end": "18:00", "priority": "high"},
+    "saturday": {"start": "09:00", "end": "17:00", "priority": "medium"},
+    "sunday": {"start": "00:00", "end": "00:00", "priority": "off"}
+}
+
+def copy_schedule(schedule: Dict[str, Any]) -> Dict[str, Any]:
+    """Copy a schedule; each day is a flat dict, so one level of copying is enough"""
+    return {day: dict(times) for day, times in schedule.items()}
+
+@lru_cache(maxsize=1024)
+def schedule_for_constraints(frozen_constraints: frozenset) -> Dict[str, Any]:
+    """Build the schedule for a frozen set of constraints (memoized)
+
+    The result is shared between callers; hand out copy_schedule() copies.
+    """
+    constraints = thaw(frozen_constraints)
+    base_schedule = copy_schedule(BASE_SCHEDULE_TEMPLATE)
+
+    # Apply constraints
+    if "class_schedule" in constraints:
+        class_hours = constraints["class_schedule"]
+        for day in base_schedule:
+            if day.lower() in ["saturday", "sunday"] and not class_hours.get("weekends", False):
+                base_schedule[day] = {"start": "00:00", "end": "00:00", "priority": "off"}
+
+    if "energy_budget" in constraints:
+        budget = constraints["energy_budget"]
+        if budget < 50:  # Low budget
+            for day in base_schedule:
+                if base_schedule[day]["priority"] == "high":
+                    base_schedule[day]["priority"] = "medium"
+
+    return base_schedule
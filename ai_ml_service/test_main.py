@@ -207,11 +207,7 @@ class TestAIMLService:
 
     def test_concurrent_requests(self):
         """Test handling concurrent requests for different devices"""
-        import threading
-        import time
-
-        results = []
-        errors = []
+        from concurrent.futures import ThreadPoolExecutor
 
         def make_request(device_id):
             try:
@@ -221,21 +217,17 @@ class TestAIMLService:
                     "periods": 2
                 }
                 response = client.post("/forecast", json=request_data)
-                results.append((device_id, response.status_code))
+                return device_id, response.status_code, None
             except Exception as e:
-                errors.append((device_id, str(e)))
-
-        # Create threads for concurrent requests
-        threads = []
-        for i in range(5):
-            device_id = f"concurrent_device_{i}"
-            thread = threading.Thread(target=make_request, args=(device_id,))
-            threads.append(thread)
-            thread.start()
-
-        # Wait for all threads to complete
-        for thread in threads:
-            thread.join()
+                return device_id, None, str(e)
+
+        # Issue the requests concurrently from a worker pool
+        device_ids = [f"concurrent_device_{i}" for i in range(5)]
+        with ThreadPoolExecutor(max_workers=5) as pool:
+            outcomes = list(pool.map(make_request, device_ids))
+
+        results = [(d, code) for d, code, err in outcomes if err is None]
+        errors = [(d, err) for d, _, err in outcomes if err is not None]
 
         # Check results
         assert len(results) == 5
@@ -0,0 +1,275 @@
+import asyncio
+import pickle
+from collections import deque
+from unittest.mock import patch
+
+import lz4.frame
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+import main_improved
+from main_improved import (
+    app,
+    AnomalyDetector,
+    save_model,
+    load_model,
+    MODEL_SUFFIX,
+    _score_forest,
+)
+from sklearn.ensemble import IsolationForest
+
+client = TestClient(app)
+
+
+@pytest.fixture
+def models_dir(tmp_path, monkeypatch):
+    """Point model persistence at a temporary directory"""
+    monkeypatch.setattr(main_improved, "MODELS_DIR", tmp_path)
+    return tmp_path
+
+
+class TestBaselineRingBuffer:
+    """AnomalyDetector's fixed-size baseline buffer"""
+
+    @pytest.fixture
+    def detector(self, monkeypatch):
+        monkeypatch.setattr(AnomalyDetector, "BASELINE_SIZE", 5)
+        return AnomalyDetector("ring_device")
+
+    def test_append_more_than_size_keeps_latest(self, detector):
+        """Appending at least BASELINE_SIZE points keeps only the newest ones"""
+        detector._append_baseline(np.array([1.0, 2.0]))
+        detector._append_baseline(np.arange(10, 17, dtype=np.float64))
+
+        np.testing.assert_array_equal(detector.baseline_values, [12.0, 13.0, 14.0, 15.0, 16.0])
+        assert detector.baseline_full
+        assert detector.baseline_idx == 0
+
+    def test_append_ending_exactly_at_size(self, detector):
+        """Filling the buffer to its end marks it full and wraps the index"""
+        detector._append_baseline(np.array([0.0, 1.0]))
+        assert not detector.baseline_full
+
+        detector._append_baseline(np.array([2.0, 3.0, 4.0]))
+        np.testing.assert_array_equal(detector.baseline_values, [0.0, 1.0, 2.0, 3.0, 4.0])
+        assert detector.baseline_full
+        assert detector.baseline_idx == 0
+
+    def test_wrapping_appends_match_reference(self, detector):
+        """Random appends keep the same points as a bounded deque"""
+        rng = np.random.default_rng(0)
+        reference = deque(maxlen=AnomalyDetector.BASELINE_SIZE)
+        for _ in range(200):
+            points = rng.normal(size=rng.integers(1, 8))
+            detector._append_baseline(points)
+            reference.extend(points)
+            assert sorted(detector.baseline_values) == sorted(reference)
+
+
+class TestMadToForest:
+    """Small baselines are scored with MAD until a forest is worth fitting"""
+
+    def test_switches_to_forest_at_limit(self, models_dir):
+        """The forest is fitted once the baseline reaches MAD_BASELINE_LIMIT"""
+        np.random.seed(42)
+        detector = AnomalyDetector("mad_device")
+        detector.train(np.random.normal(50, 1, 30).reshape(-1, 1))
+        assert detector.trained and detector.uses_mad
+
+        while detector.uses_mad:
+            before = len(detector.baseline_values)
+            assert before < AnomalyDetector.MAD_BASELINE_LIMIT
+            detector.predict(np.random.normal(50, 1, 7).reshape(-1, 1))
+
+        # Fitted on the first predict that took the baseline to the limit
+        assert len(detector.baseline_values) >= AnomalyDetector.MAD_BASELINE_LIMIT
+        assert hasattr(detector.model, "estimators_")
+
+    def test_small_first_batch_stays_on_mad(self, models_dir):
+        """Baselines of 10-49 points don't get a forest"""
+        detector = AnomalyDetector("mad_small_device")
+        detector.train(np.linspace(45, 55, 49).reshape(-1, 1))
+
+        assert detector.trained and detector.uses_mad
+        assert not hasattr(detector.model, "estimators_")
+
+
+class TestDetectorLocks:
+    """Per-device locks used while loading detectors"""
+
+    def test_locks_are_per_event_loop(self):
+        """Each event loop gets locks of its own, so contention never crosses loops"""
+        async def contend(device_id):
+            lock = main_improved._detector_lock(device_id)
+
+            async def hold():
+                async with lock:
+                    await asyncio.sleep(0.01)
+
+            # A waiter binds the lock to this loop
+            await asyncio.gather(hold(), hold())
+            return lock
+
+        first = asyncio.run(contend("lock_device"))
+        second = asyncio.run(contend("lock_device"))
+        assert first is not second
+
+
+class TestModelPersistence:
+    """Save/load of detectors in the compressed pickle format"""
+
+    def test_detector_round_trip(self, models_dir):
+        """A saved detector reloads as the current class with the same state"""
+        np.random.seed(42)
+        detector = AnomalyDetector("persist_device")
+        detector.train(np.random.normal(50, 5, 60).reshape(-1, 1))
+
+        save_model("persist_device", "anomaly", detector)
+        path = models_dir / f"persist_device_anomaly{MODEL_SUFFIX}"
+        raw = lz4.frame.decompress(path.read_bytes())
+        # Classes are stored by reference, not embedded by value
+        assert b"_make_skeleton_class" not in raw
+
+        loaded = load_model("persist_device", "anomaly")
+        assert type(loaded) is AnomalyDetector
+        assert loaded.trained and not loaded.uses_mad
+        # Inline fits use all cores; the copy shipped to scoring workers doesn't
+        assert pickle.loads(loaded.model_bytes).n_jobs == 1
+        np.testing.assert_array_equal(loaded.baseline_values, detector.baseline_values)
+
+        probe = np.array([[50.0], [200.0]])
+        np.testing.assert_allclose(_score_forest(loaded.model, probe)[0],
+                                   _score_forest(detector.model, probe)[0])
+
+    def test_load_legacy_list_baseline(self):
+        """Detectors pickled before the ring buffer had a list baseline"""
+        np.random.seed(42)
+        legacy_values = np.random.normal(50, 5, 40).tolist()
+        legacy = AnomalyDetector.__new__(AnomalyDetector)
+        legacy.__dict__.update(
+            device_id="legacy_device",
+            model=IsolationForest(random_state=42).fit(np.reshape(legacy_values, (-1, 1))),
+            trained=True,
+            baseline=legacy_values,
+        )
+
+        loaded = pickle.loads(pickle.dumps(legacy))
+        assert isinstance(loaded.baseline, np.ndarray)
+        assert len(loaded.baseline) == AnomalyDetector.BASELINE_SIZE
+        np.testing.assert_array_equal(loaded.baseline_values, legacy_values)
+        # Legacy detectors always had a fitted forest
+        assert not loaded.uses_mad
+
+        anomalies, scores = loaded.predict(np.array([[50.0]] * 9 + [[500.0]]))
+        assert 9 in anomalies
+        assert len(loaded.baseline_values) > len(legacy_values)
+
+    def test_load_missing_model(self, models_dir):
+        """Loading a device with no saved model returns None"""
+        assert load_model("missing_device", "anomaly") is None
+
+
+class TestAnomalyEndpoint:
+    """/anomaly with forest fits running in worker processes"""
+
+    def test_first_batch_fits_forest_off_loop(self, models_dir):
+        """A first batch large enough for a forest gets one installed"""
+        np.random.seed(42)
+        values = np.random.normal(50, 5, 60).tolist()
+
+        response = client.post("/anomaly", json={"device_id": "fit_device", "values": values})
+        assert response.status_code == 200
+        assert response.json()["anomalies"] == []
+
+        detector = main_improved.anomaly_detectors["fit_device"]
+        assert detector.trained and not detector.uses_mad
+        # Pooled fits don't spawn a thread per core inside each worker
+        assert detector.model.n_jobs == 1
+        assert pickle.loads(detector.model_bytes).n_jobs == 1
+
+        # Later batches are scored by the installed forest
+        response = client.post("/anomaly", json={"device_id": "fit_device", "values": values[:20] + [500.0]})
+        assert response.status_code == 200
+        assert 20 in response.json()["anomalies"]
+        main_improved.anomaly_detectors.pop("fit_device", None)
+
+
+@pytest.mark.skipif(not main_improved.PROPHET_AVAILABLE, reason="Prophet not installed")
+class TestForecastBatch:
+    """/forecast/batch mixing simple and Prophet forecasts"""
+
+    def test_mixed_batch_keeps_order(self):
+        """Each item gets its own method, results come back in request order"""
+        np.random.seed(42)
+        prophet_history = (50 + 10 * np.sin(np.arange(48) / 4) + np.random.normal(0, 2, 48)).tolist()
+        items = [
+            {"device_id": "batch_prophet", "history": prophet_history, "periods": 3},
+            {"device_id": "batch_average", "history": [40.0, 42.0], "periods": 2},
+            # No periods to predict makes Prophet's predict fail for this item only
+            {"device_id": "batch_failing", "history": prophet_history, "periods": 0},
+            {"device_id": "batch_moving", "history": [10.0, 20.0, 30.0, 40.0], "periods": 4},
+        ]
+
+        try:
+            response = client.post("/forecast/batch", json={"requests": items})
+            assert response.status_code == 200
+            data = response.json()
+
+            assert [r["device_id"] for r in data] == [item["device_id"] for item in items]
+            assert [r["model_type"] for r in data] == [
+                "prophet", "simple_average", "moving_average_fallback", "moving_average"
+            ]
+            for result, item in zip(data, items):
+                assert len(result["forecast"]) == item["periods"]
+                assert len(result["confidence"]) == item["periods"]
+        finally:
+            for item in items:
+                client.delete(f"/models/{item['device_id']}")
+
+
+class TestMovingAverage:
+    """Moving-average forecasts, including the compiled long-horizon kernel"""
+
+    def test_jit_kernel_matches_python_loop(self):
+        """Long horizons through _sma_core match the deque recurrence"""
+        history = [10.0, 20.0, 30.0, 35.0]
+        periods = main_improved.SMA_JIT_MIN_PERIODS
+
+        fast, _ = main_improved.simple_moving_average_forecast(history, periods)
+        slow, _ = main_improved.simple_moving_average_forecast(history, periods - 1)
+
+        assert len(fast) == periods
+        np.testing.assert_allclose(fast[:periods - 1], slow)
+
+
+@pytest.mark.skipif(not main_improved.PROPHET_AVAILABLE, reason="Prophet not installed")
+class TestProphetCache:
+    """Fitted Prophet models reused for unchanged histories"""
+
+    def test_unchanged_history_reuses_saved_model(self):
+        """A restarted service reloads the fitted model from disk and reuses it"""
+        np.random.seed(42)
+        history = (50 + 10 * np.sin(np.arange(48) / 4) + np.random.normal(0, 2, 48)).tolist()
+        request_data = {"device_id": "cache_device", "history": history, "periods": 3}
+
+        try:
+            first = client.post("/forecast", json=request_data).json()
+            assert first["model_type"] == "prophet"
+
+            # Simulate a restart: only the saved model is left
+            main_improved.prophet_cache.clear()
+            second = client.post("/forecast", json=request_data).json()
+            assert "cache_device" in main_improved.prophet_cache
+            np.testing.assert_allclose(second["forecast"], first["forecast"])
+
+            # Cache hits are predicted in-process, never pickled to a worker
+            with patch.object(main_improved.EXECUTOR, "submit", side_effect=AssertionError("shipped to worker")), \
+                    patch.object(main_improved, "Parallel", side_effect=AssertionError("shipped to worker")):
+                third = client.post("/forecast", json=request_data).json()
+                batch = client.post("/forecast/batch", json={"requests": [request_data]}).json()
+            assert third["model_type"] == "prophet"
+            assert batch[0]["model_type"] == "prophet"
+            np.testing.assert_allclose(batch[0]["forecast"], first["forecast"])
+        finally:
+            client.delete("/models/cache_device")